@@ -1,6 +1,7 @@
 #!/usr/bin/env python3
 
 import argparse
+import csv
 import logging
 import sys
 import subprocess
@@ -11,11 +12,21 @@ from operator import attrgetter
 import fcntl
 import time
 import fnmatch
-from distutils.version import StrictVersion
 import hashlib
+import itertools
+import io
 import json
+import tempfile
 import contextlib
+import copy
+import atexit
+import errno
+import shutil
+import signal
+import string
 from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+import threading
 
 import yaml
 from dateutil.relativedelta import relativedelta
@@ -25,22 +36,180 @@ try:
 except ImportError:
     from scandir import scandir
 
+# Prefer the libyaml based loader and dumper which are much faster than the
+# pure Python implementations
+try:
+    from yaml import CSafeLoader as YAMLSafeLoader
+    from yaml import CSafeDumper as YAMLSafeDumper
+except ImportError:
+    from yaml import SafeLoader as YAMLSafeLoader
+    from yaml import SafeDumper as YAMLSafeDumper
+
 
 VERSION = '3.8.0'
 PROPERTY_PREFIX = 'zfssnap'
 ZFSSNAP_LABEL = '%s:label' % PROPERTY_PREFIX
 ZFSSNAP_REPL_STATUS = '%s:repl_status' % PROPERTY_PREFIX
 ZFSSNAP_VERSION = '%s:version' % PROPERTY_PREFIX
+
+# The only properties zfssnap reads. Fetching only these keeps the zfs list
+# output small on hosts with many datasets and snapshots.
+CACHED_PROPERTIES = [
+    'type',
+    'readonly',
+    ZFSSNAP_LABEL,
+    ZFSSNAP_REPL_STATUS,
+    ZFSSNAP_VERSION
+]
+CONFIG_CACHE = '/var/cache/zfssnap/config.json'
+
+# Matches the names of the snapshots created by zfssnap
+SNAPSHOT_RE = re.compile(r'^.+@zfssnap_[0-9]{8}T[0-9]{6}Z$')
+# The size suffixes accepted by split -b
+SIZE_RE = re.compile(r'^([0-9]+)(?:(b)|([kmgtpezy])(b|ib)?)?$', re.IGNORECASE)
+
+# Linux specific fcntl commands for resizing pipes. Not exposed by the fcntl
+# module before Python 3.10.
+F_SETPIPE_SZ = 1031
+F_GETPIPE_SZ = 1032
 LOGGER = logging.getLogger(__name__)
 
 
-def autotype(value):
-    for fn in [int]:
+def parse_size(value):
+    """Convert a size like '512k', '1M' or '1GB' to bytes. Supports the same
+    suffixes as split -b, e.g. 'K' and 'KiB' are 1024 and 'KB' is 1000."""
+    match = SIZE_RE.match(str(value).strip())
+
+    if not match:
+        raise ValueError('Invalid size: %s' % value)
+
+    number, blocks, unit, suffix = match.groups()
+    size = int(number)
+
+    if blocks:
+        return size * 512
+    if not unit:
+        return size
+
+    base = 1000 if suffix in ('B', 'b') else 1024
+    return size * base ** ('kmgtpezy'.index(unit.lower()) + 1)
+
+
+def parse_version(version):
+    """Convert a version string like '3.8.0' to a comparable tuple"""
+    parts = tuple(int(part) for part in version.split('.'))
+    # Pad short versions so that '3.8' compares equal to '3.8.0'
+    return parts + (0,) * (3 - len(parts))
+
+
+def timestamp_to_datetime(ts):
+    """Convert a zfssnap timestamp, e.g. '20170116T160746Z', to a datetime"""
+    # Slice the fixed width timestamp directly as this is called for every
+    # snapshot when evaluating retention, which makes strptime costly
+    return datetime(int(ts[0:4]), int(ts[4:6]), int(ts[6:8]),
+                    int(ts[9:11]), int(ts[11:13]), int(ts[13:15]),
+                    tzinfo=timezone.utc)
+
+
+def get_pipe_max_size():
+    """Returns the largest pipe size allowed for unprivileged processes"""
+    try:
+        with open('/proc/sys/fs/pipe-max-size') as f:
+            return int(f.read())
+    except (OSError, ValueError):
+        return None
+
+
+def set_pipe_size(fd, size):
+    """Try to resize the pipe. Returns the resulting pipe size or None."""
+    try:
+        fcntl.fcntl(fd, F_SETPIPE_SZ, size)
+        return fcntl.fcntl(fd, F_GETPIPE_SZ)
+    except OSError as e:
+        # Unprivileged processes can not exceed pipe-max-size. Use the
+        # largest allowed size instead.
+        max_size = get_pipe_max_size()
+        if isinstance(e, PermissionError) and max_size and max_size < size:
+            LOGGER.debug('Pipe size %d exceeds pipe-max-size. Using %d bytes',
+                         size, max_size)
+            return set_pipe_size(fd, max_size)
+
+        LOGGER.debug('Unable to set pipe size to %d bytes: %s', size, e)
         try:
-            return fn(value)
-        except ValueError:
-            pass
-    return value
+            return fcntl.fcntl(fd, F_GETPIPE_SZ)
+        except OSError:
+            return None
+
+
+def copy_fd(in_fd, out_fd, size=None, chunk_size=1 << 20):
+    """Copy size bytes, or until EOF, from in_fd to out_fd. Returns the
+    number of bytes copied."""
+    copied = 0
+    use_splice = hasattr(os, 'splice')
+
+    while size is None or copied < size:
+        count = chunk_size if size is None else min(chunk_size, size - copied)
+
+        if use_splice:
+            # splice moves the data between a file and a pipe inside the
+            # kernel instead of copying it through user space
+            try:
+                n = os.splice(in_fd, out_fd, count)
+            except OSError as e:
+                # Not all file systems support splice. A failed call does
+                # not move any data, so just continue without it.
+                if e.errno != errno.EINVAL:
+                    raise
+                LOGGER.debug('Unable to splice: %s', e)
+                use_splice = False
+                continue
+        else:
+            data = memoryview(os.read(in_fd, count))
+            n = len(data)
+
+            while data:
+                data = data[os.write(out_fd, data):]
+
+        if not n:
+            break
+        copied += n
+
+    return copied
+
+
+def copy_files_to_fd(paths, fd, chunk_size=1 << 20):
+    """Write the content of the files in order to fd, e.g. a pipe"""
+    for path in paths:
+        with open(path, 'rb') as f:
+            copy_fd(f.fileno(), fd, chunk_size=chunk_size)
+
+
+def write_segments(fd, prefix, segment_size, suffix_length=4, chunk_size=1 << 20):
+    """Split the stream from fd into files named like split does, e.g.
+    prefix + 'aaaa'. Returns the paths of the segments."""
+    segments = []
+    suffixes = itertools.product(string.ascii_lowercase, repeat=suffix_length)
+
+    for suffix in suffixes:
+        path = prefix + ''.join(suffix)
+
+        with open(path, 'wb') as f:
+            size = copy_fd(fd, f.fileno(), segment_size, chunk_size)
+
+        if not size:
+            os.remove(path)
+            return segments
+
+        LOGGER.info('Created segment %s', path)
+        segments.append(path)
+
+        if size < segment_size:
+            return segments
+
+    if os.read(fd, 1):
+        raise ReplicationException(
+            'Too many segments for suffix length %s' % suffix_length)
+    return segments
 
 
 class MetadataFileException(Exception):
@@ -67,6 +236,7 @@ class MetadataFile(object):
         self.path = path
         self._version = None
         self._timestamp = None
+        self._datetime = None
         self._label = None
         self._snapshot = None
         self._depends_on = None
@@ -191,23 +361,99 @@ class MetadataFile(object):
         if not re.match(pattern, timestamp):
             raise MetadataFileException('Invalid timestamp \'%s\'' % timestamp)
         self._timestamp = timestamp
+        self._datetime = None
 
     @property
     def datetime(self):
-        strptime_name = re.sub(r'Z$', '+0000', self.timestamp)
-        return datetime.strptime(strptime_name, '%Y%m%dT%H%M%S%z')
+        if not self._datetime:
+            self._datetime = timestamp_to_datetime(self.timestamp)
+        return self._datetime
 
 
 class Config(object):
-    def __init__(self, config_file):
+    # Parsed configs for this process keyed by the config file signature
+    _parsed = {}
+
+    def __init__(self, config_file, cache_file=None):
         if config_file is None:
             config_file = '/etc/zfssnap/zfssnap.yml'
 
-        with open(config_file) as f:
-            self.config = yaml.safe_load(f)
+        if cache_file is None:
+            cache_file = CONFIG_CACHE
 
+        self.config = self._load(config_file, cache_file)
         self.global_defaults = self._get_global_defaults()
 
+        # The same policy is looked up several times per run
+        self._policies = {}
+
+    def _load(self, config_file, cache_file):
+        # Reuse the previously parsed config as long as the config file is
+        # unchanged, as parsing YAML is slow compared to loading JSON
+        st = os.stat(config_file)
+        signature = [os.path.abspath(config_file), st.st_mtime_ns, st.st_size, st.st_ino]
+        config = self._parsed.get(tuple(signature), None)
+
+        if config is None:
+            config = self._read_cache(cache_file, signature)
+
+            if config is None:
+                with open(config_file, 'rb') as f:
+                    config = yaml.load(f, Loader=YAMLSafeLoader)
+                self._write_cache(cache_file, signature, config)
+
+            self._parsed[tuple(signature)] = config
+
+        # Return a copy so that changes to one instance's config does not
+        # leak into other instances
+        return copy.deepcopy(config)
+
+    @staticmethod
+    def _read_cache(cache_file, signature):
+        try:
+            with open(cache_file) as f:
+                cached_signature, config = json.load(f)
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError, TypeError) as e:
+            LOGGER.debug('Could not read config cache %s: %s', cache_file, e)
+            return None
+
+        if cached_signature != signature:
+            return None
+
+        LOGGER.debug('Using cached config from %s', cache_file)
+        return config
+
+    @staticmethod
+    def _write_cache(cache_file, signature, config):
+        cache_dir = os.path.dirname(cache_file)
+
+        try:
+            data = json.dumps([signature, config])
+
+            # JSON converts non-string keys to strings and has no tuples, so
+            # only cache configs that are loaded back unchanged
+            if json.loads(data)[1] != config:
+                LOGGER.debug('Not caching config as it does not survive a '
+                             'JSON round trip')
+                return
+
+            os.makedirs(cache_dir, mode=0o700, exist_ok=True)
+
+            # Write to a temporary file and rename it in place so that
+            # concurrent runs never see a partially written cache
+            fd, tmp_file = tempfile.mkstemp(dir=cache_dir)
+            try:
+                with os.fdopen(fd, 'w') as f:
+                    f.write(data)
+                os.replace(tmp_file, cache_file)
+            except Exception:
+                os.remove(tmp_file)
+                raise
+        except (OSError, TypeError, ValueError) as e:
+            LOGGER.debug('Could not write config cache %s: %s', cache_file, e)
+
     def _merge(self, d1, d2):
         """Merges dictionary d2 into d1. Modifies d1 inplace"""
         for k in d2:
@@ -224,8 +470,7 @@ class Config(object):
             'cmds': {
                 'ssh': '/usr/bin/ssh',
                 'zfs': '/sbin/zfs',
-                'split': '/usr/bin/split',
-                'cat': '/bin/cat'
+                'pv': '/usr/bin/pv'
             },
             'keep': {
                 'latest': 0,
@@ -240,6 +485,11 @@ class Config(object):
         return self._merge(defaults, user_defaults)
 
     def get_policy(self, policy):
+        if policy not in self._policies:
+            self._policies[policy] = self._get_policy(policy)
+        return self._policies[policy]
+
+    def _get_policy(self, policy):
         try:
             user_config = self.config['policies'][policy]
         except KeyError:
@@ -248,8 +498,10 @@ class Config(object):
 
         policy_type = user_config['type']
         defaults = {
-            'keep': self.global_defaults['keep'],
-            'label': user_config.get('label', policy)
+            # Copy the global keep values as the policy values are merged
+            # into them
+            'keep': dict(self.global_defaults['keep']),
+            'label': policy
         }
 
         if policy_type == 'snapshot':
@@ -257,30 +509,39 @@ class Config(object):
                 'cmds': {
                     'zfs': self.global_defaults['cmds']['zfs']
                 },
-                'recursive': False
+                'recursive': False,
+                'parallel': 8
             })
         elif policy_type == 'replicate':
             defaults.update({
                 'source': {
                     'cmds': {
                         'zfs': self.global_defaults['cmds']['zfs'],
-                        'ssh': self.global_defaults['cmds']['ssh']
+                        'ssh': self.global_defaults['cmds']['ssh'],
+                        'pv': self.global_defaults['cmds']['pv']
                     }
                 },
                 'destination': {
                     'host': None,
                     'ssh_user': None,
+                    'ssh_control_master': False,
+                    'ssh_cipher': None,
                     'read_only': True,
                     'cmds': {
                         'zfs': self.global_defaults['cmds']['zfs'],
+                        'mbuffer': self.global_defaults['cmds'].get('mbuffer', None)
                     }
-                }
+                },
+                'buffer_size': '128k',
+                'buffer_mem': '1G',
+                'pipe_size': '1M',
+                'send_flags': []
             })
         elif policy_type == 'send_to_file':
             defaults.update({
                 'cmds': {
                     'zfs': self.global_defaults['cmds']['zfs'],
-                    'split': self.global_defaults['cmds']['split']
+                    'pv': self.global_defaults['cmds']['pv']
                 },
                 'file_prefix': 'zfssnap',
                 'suffix_length': 4,
@@ -290,7 +551,7 @@ class Config(object):
             defaults.update({
                 'cmds': {
                     'zfs': self.global_defaults['cmds']['zfs'],
-                    'cat': self.global_defaults['cmds']['cat']
+                    'pv': self.global_defaults['cmds']['pv']
                 },
                 'file_prefix': 'zfssnap',
                 'destination': {
@@ -299,7 +560,31 @@ class Config(object):
             })
 
         self._validate_keep(user_config.get('keep', {}))
-        return self._merge(defaults, user_config)
+        self._validate_parallel(user_config.get('parallel', 1))
+        policy_config = self._merge(defaults, user_config)
+
+        # Labels are compared with the string values of the ZFS property,
+        # so YAML values like 'label: 123' must be converted after the merge
+        policy_config['label'] = str(policy_config['label'])
+
+        for key in ('pipe_size', 'split_size'):
+            if policy_config.get(key, None):
+                self._validate_size(key, policy_config[key])
+
+        return policy_config
+
+    @staticmethod
+    def _validate_parallel(parallel):
+        if not isinstance(parallel, int) or parallel < 1:
+            raise ConfigException(
+                'parallel must be a positive integer (%s)' % parallel)
+
+    @staticmethod
+    def _validate_size(name, size):
+        try:
+            parse_size(size)
+        except ValueError:
+            raise ConfigException('%s is not a valid size (%s)' % (name, size))
 
     def _validate_keep(self, keep):
         for key, value in keep.items():
@@ -319,7 +604,10 @@ class Dataset(object):
             for name, value in properties.items():
                 self.host.cache_add_property(self.name, name, value)
 
-    def _destroy(self, recursive=False, defer=False):
+    def _destroy(self, recursive=False, defer=False, name=None):
+        if name is None:
+            name = self.name
+
         args = ['destroy']
 
         if recursive:
@@ -328,23 +616,46 @@ class Dataset(object):
         if defer:
             args.append('-d')
 
-        args.append(self.name)
+        args.append(name)
         cmd = self.host.get_cmd('zfs', args)
-        subprocess.check_output(cmd, stderr=subprocess.STDOUT)
+        subprocess.check_output(cmd, stderr=subprocess.STDOUT, close_fds=False)
 
     def set_property(self, name, value):
-        if value is None:
-            self.unset_property(name)
+        self.set_properties({name: value})
+
+    def set_properties(self, properties):
+        args = ['set']
+
+        for name, value in sorted(properties.items()):
+            if value is None:
+                self.unset_property(name)
+                continue
+            args.append('%s=%s' % (name, value))
+
+        if len(args) == 1:
             return
 
-        args = [
-            'set',
-            '%s=%s' % (name, value),
-            self.name
-        ]
+        args.append(self.name)
         cmd = self.host.get_cmd('zfs', args)
-        subprocess.check_call(cmd)
-        self.host.cache_add_property(self.name, name, value)
+
+        try:
+            subprocess.check_call(cmd, close_fds=False)
+        except subprocess.CalledProcessError:
+            # zfs set only accepts multiple properties from ZFS on Linux
+            # 0.7.0. Fall back to one zfs set per property on older versions.
+            if len(args) == 3:
+                raise
+
+            LOGGER.debug('Unable to set multiple properties at once. '
+                         'Setting them one by one')
+
+            for arg in args[1:-1]:
+                cmd = self.host.get_cmd('zfs', ['set', arg, self.name])
+                subprocess.check_call(cmd, close_fds=False)
+
+        for name, value in properties.items():
+            if value is not None:
+                self.host.cache_add_property(self.name, name, value)
 
     def unset_property(self, name):
         args = [
@@ -353,17 +664,22 @@ class Dataset(object):
             self.name
         ]
         cmd = self.host.get_cmd('zfs', args)
-        subprocess.check_call(cmd)
+        subprocess.check_call(cmd, close_fds=False)
         self.host.cache_remove_property(self.name, name)
 
     def get_properties(self, refresh=False):
-        return self.host.get_properties_cached(refresh)[self.name]
+        return self.host.cache_get_properties(self.name, refresh)
 
     def get_property(self, name):
-        value = self.get_properties().get(name, None)
-        if not value:
-            LOGGER.debug('The zfs property \'%s\' was not found in cache '
-                         'for %s. Trying to refresh', name, self.name)
+        properties = self.get_properties()
+        value = properties.get(name, None)
+
+        # The cache holds all the properties zfssnap reads, so a missing
+        # property is only worth a refresh if the dataset itself is unknown
+        # to the cache. Otherwise the property is simply not set.
+        if value is None and 'type' not in properties:
+            LOGGER.debug('%s was not found in cache. Trying to refresh',
+                         self.name)
             value = self.get_properties(refresh=True).get(name, None)
         if not value:
             LOGGER.debug('The zfs property \'%s\' does not exist for %s',
@@ -387,17 +703,6 @@ class Snapshot(Dataset):
         self._version = None
         self.keep_reasons = []
 
-    def destroy(self, recursive=False, defer=True):
-        LOGGER.info('Destroying snapshot %s', self.name)
-        try:
-            self._destroy(recursive, defer)
-        except subprocess.CalledProcessError as e:
-            if b'could not find any snapshots to destroy' in e.output:
-                LOGGER.warning('%s does not exist', self.name)
-            else:
-                raise
-        self.host.cache_remove_snapshot(self)
-
     @property
     def timestamp(self):
         _, timestamp = self.snapshot_name.split('_')
@@ -406,8 +711,7 @@ class Snapshot(Dataset):
     @property
     def datetime(self):
         if not self._datetime:
-            strptime_name = re.sub(r'Z$', '+0000', self.snapshot_name)
-            self._datetime = datetime.strptime(strptime_name, 'zfssnap_%Y%m%dT%H%M%S%z')
+            self._datetime = timestamp_to_datetime(self.timestamp)
         return self._datetime
 
     @property
@@ -455,31 +759,65 @@ class FsVol(Dataset):
 
     def get_latest_repl_snapshot(self, label=None, status='success',
                                  refresh=False):
-        snapshots = sorted(self.get_snapshots(label=label, refresh=refresh),
-                           key=attrgetter('datetime'),
-                           reverse=True)
+        snapshots = (s for s in self.get_snapshots(label=label, refresh=refresh)
+                     if s.repl_status == status)
 
-        for snapshot in snapshots:
-            if snapshot.repl_status == status:
-                return snapshot
+        # The timestamp based names sort chronologically
+        return max(snapshots, key=attrgetter('snapshot_name'), default=None)
 
     def destroy(self, recursive=False):
         LOGGER.info('Destroying %s %s', self.get_property('type'), self.name)
         self._destroy(recursive)
         self.host.cache_remove_fsvol(self)
 
+    def destroy_snapshots(self, snapshots, recursive=False, defer=True):
+        # zfs destroy accepts a comma separated list of snapshots which are
+        # destroyed in one operation. Split the list in chunks to stay well
+        # below the argument length limit.
+        chunk_size = 100
+
+        for i in range(0, len(snapshots), chunk_size):
+            chunk = snapshots[i:i + chunk_size]
+
+            for snapshot in chunk:
+                LOGGER.info('Destroying snapshot %s', snapshot.name)
+
+            name = '%s@%s' % (self.name, ','.join(s.snapshot_name for s in chunk))
+
+            try:
+                self._destroy(recursive, defer, name)
+            except subprocess.CalledProcessError as e:
+                if b'could not find any snapshots to destroy' in e.output:
+                    LOGGER.warning('%s does not exist', name)
+                else:
+                    raise
+
+            for snapshot in chunk:
+                self.host.cache_remove_snapshot(snapshot)
+
     def get_snapshots(self, label=None, refresh=False):
-        for snapshot in self.host.cache_get_snapshots(refresh):
-            if snapshot.dataset_name != self.name:
-                continue
-            if label and snapshot.label != label:
+        snapshots = list(self.host.cache_get_snapshots(refresh, self.name))
+
+        # Look up the labels in the cached properties directly instead of
+        # going through the label property of every snapshot
+        properties = self.host.get_properties_cached()
+
+        for snapshot in snapshots:
+            if label and properties.get(snapshot.name, {}).get(ZFSSNAP_LABEL, None) != label:
                 continue
             yield snapshot
 
     def get_snapshot(self, name, refresh=False):
-        for snapshot in self.get_snapshots(refresh=refresh):
-            if snapshot.snapshot_name == name:
-                return snapshot
+        return self.host.cache_get_snapshot('%s@%s' % (self.name, name), refresh)
+
+    def load_snapshot(self, name):
+        # Only fetch the new snapshot instead of refreshing the whole cache
+        snapshot = self.host.cache_load_snapshot('%s@%s' % (self.name, name))
+
+        if snapshot is None:
+            snapshot = self.get_snapshot(name, refresh=True)
+
+        return snapshot
 
     def get_base_snapshot(self, label=None, base_snapshot=None):
         if base_snapshot:
@@ -492,66 +830,70 @@ class FsVol(Dataset):
             snapshot = self.get_latest_repl_snapshot(label)
         return snapshot
 
-    def get_send_cmd(self, snapshot, base_snapshot):
+    def has_compression(self):
+        # The send stream is recursive, so check the child datasets as well
+        args = [
+            'get', 'compression',
+            '-r',
+            '-H',
+            '-o', 'value',
+            '-t', 'filesystem,volume',
+            self.name
+        ]
+        cmd = self.host.get_cmd('zfs', args)
+        output = subprocess.check_output(cmd, close_fds=False).decode('utf8')
+        return any(value != 'off' for value in output.splitlines())
+
+    def get_send_cmd(self, snapshot, base_snapshot, send_flags=None):
         send_args = ['send', '-R']
 
+        if send_flags:
+            supported_flags = self.host.get_supported_send_flags()
+
+            # A compressed stream requires support on the receiving side even
+            # if there is nothing compressed to send
+            if '-c' in send_flags and not self.has_compression():
+                LOGGER.debug('Compression is off for %s. Ignoring \'-c\'.', self.name)
+                send_flags = [f for f in send_flags if f != '-c']
+
+            for flag in send_flags:
+                if flag.startswith('--') or set(flag.lstrip('-')) <= supported_flags:
+                    send_args.append(flag)
+                else:
+                    LOGGER.warning('zfs send does not support \'%s\'. Ignoring.', flag)
+
         if base_snapshot:
             send_args.extend(['-I', '@%s' % base_snapshot.snapshot_name])
 
         send_args.append(snapshot.name)
         return self.host.get_cmd('zfs', send_args)
 
-    def get_cat_cmd(self, segments):
-        return self.host.get_cmd('cat', segments)
-
     def get_receive_cmd(self):
         receive_args = ['receive', '-F', '-v', self.name]
         return self.host.get_cmd('zfs', receive_args)
 
-    def get_split_cmd(self, prefix, split_size='1G', suffix_length=4):
-        LOGGER.info('Splitting at segment size %s', split_size)
-        split_args = [
-            '--bytes=%s' % split_size,
-            '--suffix-length=%s' % suffix_length,
-            '--verbose',
-            '-',
-            prefix
-        ]
-        return self.host.get_cmd('split', split_args)
-
-    def snapshot(self, label, recursive=False, ts=None):
-        if ts is None:
-            ts = datetime.utcnow()
-
-        if label == '-':
-            raise SnapshotException('\'%s\' is not a valid label' % label)
-
-        timestamp = ts.strftime('%Y%m%dT%H%M%SZ')
-        name = '%s@zfssnap_%s' % (self.name, timestamp)
-        LOGGER.info('Creating snapshot %s (label: %s)', name, label)
-        properties = {
-            ZFSSNAP_LABEL: label,
-            ZFSSNAP_VERSION: VERSION
-        }
-
-        args = [
-            'snapshot',
+    def get_buffered_receive_cmd(self, buffer_args):
+        # The pipe is interpreted by the remote shell, so this only works
+        # when the command is run through ssh
+        receive_args = [
+            '|',
+            self.host.cmds['zfs'],
+            'receive', '-F', '-v', self.name
         ]
+        return self.host.get_cmd('mbuffer', buffer_args + receive_args)
 
-        for key, value in properties.items():
-            args.extend([
-                '-o', '%s=%s' % (key, value),
-            ])
+    def get_buffer_cmd(self, buffer_args):
+        return self.host.get_cmd('mbuffer', buffer_args)
 
-        if recursive:
-            args.append('-r')
+    def get_pv_cmd(self):
+        # pv only reports the progress, so it can be disabled to save a copy
+        # of the stream
+        if not self.host.cmds.get('pv', None):
+            return None
+        return self.host.get_cmd('pv', ['-rtb'])
 
-        args.append(name)
-        cmd = self.host.get_cmd('zfs', args)
-        subprocess.check_call(cmd)
-        snapshot = Snapshot(self.host, name, properties=properties)
-        self.host.cache_add_snapshot(snapshot)
-        return snapshot
+    def snapshot(self, label, recursive=False, ts=None):
+        return self.host.snapshot_fsvols([self], label, recursive, ts)[0]
 
     @staticmethod
     def _get_delta_datetimes(start, end, delta):
@@ -561,11 +903,9 @@ class FsVol(Dataset):
             current -= delta
 
     def _get_interval_snapshots(self, snapshots, start, end, delta):
-        _snapshots = sorted(snapshots, key=attrgetter('datetime'),
-                            reverse=True)
-
+        # snapshots must be sorted with the newest snapshot first
         for dt in self._get_delta_datetimes(start, end, delta):
-            for snapshot in _snapshots:
+            for snapshot in snapshots:
                 if dt <= snapshot.datetime < dt + delta:
                     yield snapshot
                     break
@@ -613,8 +953,8 @@ class FsVol(Dataset):
 
     @staticmethod
     def _get_latest_snapshots(snapshots, keep):
-        _snapshots = sorted(snapshots, key=attrgetter('datetime'), reverse=True)
-        for num, snapshot in enumerate(_snapshots):
+        # snapshots must be sorted with the newest snapshot first
+        for num, snapshot in enumerate(snapshots):
             if num >= keep:
                 break
             snapshot.add_keep_reason('latest')
@@ -623,8 +963,12 @@ class FsVol(Dataset):
     def enforce_retention(self, keep, label=None, recursive=False, reset=False,
                           replication=False):
         # Make the list of snapshots a tuple to ensure it's not getting
-        # changed while it's passed around.
-        snapshots = tuple(s for s in self.get_snapshots(label))
+        # changed while it's passed around. Sort it once here, newest first,
+        # as this is the order all the keep interval helpers expect. The
+        # timestamp based names sort chronologically, so there is no need to
+        # parse the datetime for sorting.
+        snapshots = tuple(sorted(self.get_snapshots(label),
+                                 key=attrgetter('snapshot_name'), reverse=True))
         keep_snapshots = set()
 
         if not reset:
@@ -658,46 +1002,103 @@ class FsVol(Dataset):
                 keep_snapshots.update(
                     {s for s in self._get_yearly_snapshots(snapshots, keep['yearly'])})
 
-        # Sort snapshots for less messy log output
-        for snapshot in sorted(snapshots, key=attrgetter('datetime'), reverse=True):
+        destroy_snapshots = []
+
+        for snapshot in snapshots:
             # There is no point in keeping failed replication snapshots
             if replication and snapshot.repl_status != 'success':
                 keep_snapshots.discard(snapshot)
 
             if snapshot not in keep_snapshots:
-                snapshot.destroy(recursive)
+                destroy_snapshots.append(snapshot)
                 continue
 
             LOGGER.debug('Keeping snapshot %s (reasons: %s)', snapshot.name,
                          ', '.join(snapshot.keep_reasons))
 
+        if destroy_snapshots:
+            self.destroy_snapshots(destroy_snapshots, recursive)
+
 
 class Host(object):
     def __init__(self, cmds, ssh_params=None):
         self.cmds = cmds
         self.ssh_params = ssh_params
-        self._fsvols = []
-        self._snapshots = []
+        self._fsvols = {}
+        # Snapshots by dataset name and snapshot name
+        self._snapshots = defaultdict(dict)
         self._dataset_properties = defaultdict(dict)
         self._refresh_snapshots_cache = True
         self._refresh_fsvols_cache = True
         self._refresh_properties_cache = True
+        self._supported_send_flags = None
+        self._compiled_patterns = {}
 
-    def _get_ssh_cmd(self):
+        # Protects the caches as datasets may be processed concurrently
+        self._cache_lock = threading.RLock()
+        self._ssh_control_dir = None
+
+        if self.is_remote and self.ssh_params.get('control_master', False):
+            # Multiplex all ssh commands to this host over a single
+            # connection to avoid a new ssh handshake for every zfs command
+            self._ssh_control_dir = tempfile.mkdtemp(prefix='zfssnap-')
+            atexit.register(self._close_ssh_control_master)
+
+        # The ssh part is the same for every command to this host
+        self._ssh_cmd = self._get_ssh_cmd() if self.ssh_params else []
+
+    def _get_ssh_target(self):
         user = self.ssh_params['user']
+        host = self.ssh_params['host']
+
+        if user:
+            return '%s@%s' % (user, host)
+        return host
+
+    def _get_ssh_control_path(self):
+        return os.path.join(self._ssh_control_dir, 'ssh.sock')
+
+    def _close_ssh_control_master(self):
+        if os.path.exists(self._get_ssh_control_path()):
+            LOGGER.debug('Closing ssh control master for %s', self.ssh_params['host'])
+            cmd = [
+                self.ssh_params['ssh'],
+                '-o', 'ControlPath=%s' % self._get_ssh_control_path(),
+                '-O', 'exit',
+                self._get_ssh_target()
+            ]
+            subprocess.call(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+                            close_fds=False)
+
+        shutil.rmtree(self._ssh_control_dir, ignore_errors=True)
+
+    def _get_ssh_cmd(self):
         host = self.ssh_params.get('host', None)
-        cmd = self.ssh_params['ssh']
         ssh_cmd = []
 
         if not host:
             return ssh_cmd
 
-        if user:
-            ssh_cmd = [cmd, '%s@%s' % (user, host)]
-        else:
-            ssh_cmd = [cmd, host]
+        ssh_cmd.append(self.ssh_params['ssh'])
+        cipher = self.ssh_params.get('cipher', None)
+
+        if cipher:
+            ssh_cmd.extend(['-c', cipher])
+
+        if self._ssh_control_dir:
+            ssh_cmd.extend([
+                '-o', 'ControlMaster=auto',
+                '-o', 'ControlPath=%s' % self._get_ssh_control_path(),
+                '-o', 'ControlPersist=60'
+            ])
+
+        ssh_cmd.append(self._get_ssh_target())
         return ssh_cmd
 
+    @property
+    def is_remote(self):
+        return bool(self.ssh_params and self.ssh_params.get('host', None))
+
     def get_cmd(self, name, args=None):
         if args is None:
             args = []
@@ -708,115 +1109,254 @@ class Host(object):
             raise ZFSSnapException(
                 '\'%s\' is not defined.' % name)
 
-        cmd = []
-        if self.ssh_params:
-            cmd.extend(self._get_ssh_cmd())
-
-        cmd.append(cmd_path)
+        cmd = self._ssh_cmd + [cmd_path]
         cmd.extend(args)
-        LOGGER.debug('Command: %s', ' '.join(cmd))
+
+        # Avoid building the log string on every call unless it is logged
+        if LOGGER.isEnabledFor(logging.DEBUG):
+            LOGGER.debug('Command: %s', ' '.join(cmd))
         return cmd
 
+    def get_supported_send_flags(self):
+        if self._supported_send_flags is None:
+            # zfs send without arguments prints the usage text with the
+            # supported flags, e.g. 'send [-DnPpRvLec] [-[iI] snapshot] <snapshot>'
+            cmd = self.get_cmd('zfs', ['send'])
+            p = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                                 close_fds=False)
+            output, _ = p.communicate()
+            flags = set()
+
+            for line in output.decode('utf8').split('\n'):
+                if not line.strip().startswith('send '):
+                    continue
+                for match in re.finditer(r'\[-([a-zA-Z]+)\]', line):
+                    flags.update(match.group(1))
+
+            LOGGER.debug('Supported zfs send flags: %s', ''.join(sorted(flags)))
+            self._supported_send_flags = flags
+        return self._supported_send_flags
+
+    def _run_stream(self, name, args, stderr=None):
+        # Parse the output while the command is running instead of
+        # buffering all of it, which can be large on hosts with many
+        # snapshots
+        cmd = self.get_cmd(name, args)
+
+        # Read the output in large chunks to reduce the number of read calls.
+        # All file descriptors opened by Python are non-inheritable, so
+        # close_fds is not needed and allows the faster posix_spawn path
+        # instead of fork and exec on Python >= 3.8.
+        p = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=stderr,
+                             bufsize=1 << 20, close_fds=False)
+
+        with p.stdout:
+            for line in io.TextIOWrapper(p.stdout, encoding='utf8'):
+                yield line.rstrip('\n')
+
+        # Only read stderr if it is piped. It is expected to be small as it
+        # is only used for error messages.
+        output = p.stderr.read() if p.stderr else None
+
+        if p.wait() != 0:
+            raise subprocess.CalledProcessError(p.returncode, cmd, output)
+
     def cache_refresh(self):
-        self._refresh_properties_cache = True
-        self._refresh_snapshots_cache = True
-        self._refresh_fsvols_cache = True
+        with self._cache_lock:
+            self._refresh_properties_cache = True
+            self._refresh_snapshots_cache = True
+            self._refresh_fsvols_cache = True
 
-    def _cache_refresh_properties(self):
-        LOGGER.debug('Refreshing dataset properties cache')
+    def _get_properties(self, names=None, stderr=None):
         dataset_properties = defaultdict(dict)
+
+        # zfs list prints one line per dataset with all the properties as
+        # columns, which is far less output than one line per property
+        # from zfs get
         args = [
-            'get', 'all',
+            'list',
             '-H',
             '-p',
-            '-o', 'name,property,value',
+            '-o', 'name,%s' % ','.join(CACHED_PROPERTIES),
+            '-t', 'filesystem,volume,snapshot',
         ]
-        cmd = self.get_cmd('zfs', args)
-        output = subprocess.check_output(cmd)
 
-        for line in output.decode('utf8').split('\n'):
-            if not line.strip():
+        if names:
+            args.extend(names)
+
+        # Let the C implemented csv reader split the tab separated output
+        rows = csv.reader(self._run_stream('zfs', args, stderr), delimiter='\t',
+                          quoting=csv.QUOTE_NONE)
+        columns = len(CACHED_PROPERTIES) + 1
+
+        for row in rows:
+            if not row:
+                continue
+
+            if len(row) != columns:
+                LOGGER.warning('Ignoring unexpected zfs list output: %s', row)
                 continue
-            name, zfs_property, value = line.split('\t')
-            dataset_properties[name][zfs_property] = autotype(value)
 
-        self._dataset_properties = dataset_properties
+            name = row[0]
+            properties = dataset_properties[name]
+
+            for zfs_property, value in zip(CACHED_PROPERTIES, row[1:]):
+                # zfs list prints '-' for unset user properties and for
+                # properties not applicable to the dataset type. All cached
+                # properties are strings, so no type conversion is needed.
+                # The values repeat for every snapshot, e.g. the type, label
+                # and version, so intern them to share one copy of each.
+                if value != '-':
+                    properties[zfs_property] = sys.intern(value)
+
+        return dataset_properties
+
+    def _cache_refresh_properties(self):
+        LOGGER.debug('Refreshing dataset properties cache')
+        self._dataset_properties = self._get_properties()
         self._refresh_properties_cache = False
 
+    def cache_load_snapshot(self, name):
+        """Add a snapshot created outside of zfssnap, e.g. by zfs receive,
+        to the cache without refreshing the whole cache"""
+        LOGGER.debug('Loading %s into snapshots cache', name)
+
+        try:
+            properties = self._get_properties([name])[name]
+        except subprocess.CalledProcessError:
+            return None
+
+        snapshot = Snapshot(self, name, properties)
+        self.cache_add_snapshot(snapshot)
+        return snapshot
+
     def _cache_refresh_snapshots(self):
         LOGGER.debug('Refreshing snapshots cache')
-        snapshots = []
-        snapshot_pattern = r'^.+@zfssnap_[0-9]{8}T[0-9]{6}Z$'
-        snapshot_re = re.compile(snapshot_pattern)
+        snapshots = defaultdict(dict)
         all_datasets = self.get_properties_cached()
 
         for name, properties in all_datasets.items():
             if properties['type'] != 'snapshot':
                 continue
-            # Only keep zfssnap snapshots
-            if not re.match(snapshot_re, name):
+            # Only keep zfssnap snapshots. The substring test rejects other
+            # snapshots much faster than the regex.
+            if '@zfssnap_' not in name or not SNAPSHOT_RE.match(name):
                 continue
-            snapshot = Snapshot(self, name, properties)
-            snapshots.append(snapshot)
+            # The properties are already in the cache, so there is no need
+            # to pass them on for the object to add them again
+            snapshot = Snapshot(self, name)
+            snapshots[snapshot.dataset_name][name] = snapshot
 
         self._snapshots = snapshots
         self._refresh_snapshots_cache = False
 
     def _cache_refresh_fsvols(self):
         LOGGER.debug('Refreshing fsvols cache')
-        fsvols = []
+        fsvols = {}
         all_datasets = self.get_properties_cached()
 
         for name, properties in all_datasets.items():
             if properties['type'] in {'filesystem', 'volume'}:
-                fs = FsVol(self, name, properties)
-                fsvols.append(fs)
+                fsvols[name] = FsVol(self, name)
 
         self._fsvols = fsvols
         self._refresh_fsvols_cache = False
 
     def get_properties_cached(self, refresh=False):
-        if refresh:
-            self.cache_refresh()
-        if refresh or self._refresh_properties_cache:
-            self._cache_refresh_properties()
-        return self._dataset_properties
+        with self._cache_lock:
+            if refresh:
+                self.cache_refresh()
+            if refresh or self._refresh_properties_cache:
+                self._cache_refresh_properties()
+            return self._dataset_properties
+
+    def cache_get_properties(self, dataset, refresh=False):
+        with self._cache_lock:
+            # Serve datasets that were looked up individually without loading
+            # the whole cache
+            if not refresh and self._refresh_properties_cache:
+                properties = self._dataset_properties.get(dataset, None)
+                if properties and 'type' in properties:
+                    return properties
+            return self.get_properties_cached(refresh)[dataset]
 
     def cache_add_property(self, dataset, name, value):
-        self._dataset_properties[dataset][name] = value
+        with self._cache_lock:
+            self._dataset_properties[dataset][name] = value
 
     def cache_remove_property(self, dataset, name):
-        self._dataset_properties[dataset].pop(name, None)
+        with self._cache_lock:
+            self._dataset_properties[dataset].pop(name, None)
 
-    def cache_get_snapshots(self, refresh=False):
+    def _cache_load_snapshots(self, refresh=False):
         if refresh:
             self.cache_refresh()
         if refresh or self._refresh_snapshots_cache:
             self._cache_refresh_snapshots()
-        for snapshot in self._snapshots:
+
+    def cache_get_snapshots(self, refresh=False, dataset=None):
+        # Iterate over a copy so that other threads can modify the cache
+        with self._cache_lock:
+            self._cache_load_snapshots(refresh)
+
+            if dataset is None:
+                snapshots = [s for d in self._snapshots.values() for s in d.values()]
+            else:
+                snapshots = list(self._snapshots.get(dataset, {}).values())
+        for snapshot in snapshots:
             yield snapshot
 
+    def cache_get_snapshot(self, name, refresh=False):
+        dataset, _, _ = name.partition('@')
+
+        with self._cache_lock:
+            self._cache_load_snapshots(refresh)
+            return self._snapshots.get(dataset, {}).get(name, None)
+
     def cache_add_snapshot(self, snapshot):
         LOGGER.debug('Adding %s to snapshot cache', snapshot.name)
-        self._snapshots.append(snapshot)
+        with self._cache_lock:
+            # If nothing is loaded yet the snapshot is picked up from zfs
+            # whenever the cache is loaded
+            if self._refresh_properties_cache:
+                return
+
+            if self._refresh_snapshots_cache:
+                self._cache_refresh_snapshots()
+
+            # A refresh may already have picked up the snapshot from the
+            # properties cache, so replace it rather than adding a duplicate
+            self._snapshots[snapshot.dataset_name][snapshot.name] = snapshot
 
     def cache_remove_snapshot(self, snapshot):
         LOGGER.debug('Removing %s from snapshot cache', snapshot.name)
-        self._snapshots.remove(snapshot)
-        self._dataset_properties.pop(snapshot.name)
+        with self._cache_lock:
+            del self._snapshots[snapshot.dataset_name][snapshot.name]
+            self._dataset_properties.pop(snapshot.name)
 
-    def cache_get_fsvols(self, refresh=False):
+    def _cache_load_fsvols(self, refresh=False):
         if refresh:
             self.cache_refresh()
         if refresh or self._refresh_fsvols_cache:
             self._cache_refresh_fsvols()
-        for fsvol in self._fsvols:
+
+    def cache_get_fsvols(self, refresh=False):
+        with self._cache_lock:
+            self._cache_load_fsvols(refresh)
+            fsvols = list(self._fsvols.values())
+        for fsvol in fsvols:
             yield fsvol
 
+    def cache_get_fsvol(self, name, refresh=False):
+        with self._cache_lock:
+            self._cache_load_fsvols(refresh)
+            return self._fsvols.get(name, None)
+
     def cache_remove_fsvol(self, fs):
         LOGGER.debug('Removing %s from fsvol cache', fs.name)
-        self._fsvols.remove(fs)
-        self._dataset_properties.pop(fs.name)
+        with self._cache_lock:
+            self._fsvols.pop(fs.name, None)
+            self._dataset_properties.pop(fs.name, None)
 
     def get_fsvols(self, include=None, exclude=None, recursive=False, refresh=False):
         if include is None:
@@ -824,19 +1364,113 @@ class Host(object):
         if exclude is None:
             exclude = []
         if recursive:
-            exclude.extend(['%s/*' % p for p in include])
+            # Do not extend the caller's list as it is usually the policy
+            # config, which would grow for every call
+            exclude = list(exclude) + ['%s/*' % p for p in include]
+
+        # Match all patterns in one regex instead of one match per pattern
+        exclude_re = self._compile_patterns(exclude)
+        include_re = self._compile_patterns(include)
 
         for fs in self.cache_get_fsvols(refresh):
-            if any((fnmatch.fnmatch(fs.name, p) for p in exclude)):
+            if exclude_re and exclude_re.match(fs.name):
                 continue
-            if include and not any((fnmatch.fnmatch(fs.name, p) for p in include)):
+            if include_re and not include_re.match(fs.name):
                 continue
             yield fs
 
+    def _compile_patterns(self, patterns):
+        if not patterns:
+            return None
+
+        # The same include/exclude patterns are used for every lookup in a
+        # policy run, e.g. once for the datasets and once per dataset in
+        # --list mode
+        key = tuple(patterns)
+        if key not in self._compiled_patterns:
+            self._compiled_patterns[key] = re.compile(
+                '|'.join('(?:%s)' % fnmatch.translate(p) for p in patterns))
+        return self._compiled_patterns[key]
+
     def get_fsvol(self, name, refresh=False):
-        for fs in self.cache_get_fsvols(refresh):
-            if fs.name == name:
-                return fs
+        with self._cache_lock:
+            # Building the fsvols cache is cheap if the properties are loaded
+            if (refresh or not self._refresh_fsvols_cache or
+                    not self._refresh_properties_cache):
+                return self.cache_get_fsvol(name, refresh)
+
+        # Only look up this dataset instead of loading the whole cache, which
+        # might never be needed, e.g. for replication destinations
+        LOGGER.debug('Looking up %s', name)
+
+        try:
+            properties = self._get_properties([name], stderr=subprocess.PIPE)[name]
+        except subprocess.CalledProcessError as e:
+            # Any other error, e.g. an unreachable remote host, must not be
+            # mistaken for a missing dataset
+            if e.output and b'dataset does not exist' in e.output:
+                return None
+            raise
+
+        if properties.get('type', None) not in {'filesystem', 'volume'}:
+            return None
+
+        return FsVol(self, name, properties)
+
+    def snapshot_fsvols(self, fsvols, label, recursive=False, ts=None):
+        if ts is None:
+            ts = datetime.utcnow()
+
+        if label == '-':
+            raise SnapshotException('\'%s\' is not a valid label' % label)
+
+        timestamp = ts.strftime('%Y%m%dT%H%M%SZ')
+        properties = {
+            ZFSSNAP_LABEL: label,
+            ZFSSNAP_VERSION: VERSION
+        }
+
+        # zfs snapshot accepts multiple snapshots which are created atomically
+        # in one operation, but only within the same pool. Split the list in
+        # chunks to stay well below the argument length limit.
+        chunk_size = 100
+        pools = defaultdict(list)
+
+        for fs in fsvols:
+            pools[fs.name.split('/')[0]].append(fs)
+
+        snapshots = []
+
+        for pool_fsvols in pools.values():
+            for i in range(0, len(pool_fsvols), chunk_size):
+                chunk = pool_fsvols[i:i + chunk_size]
+                names = ['%s@zfssnap_%s' % (fs.name, timestamp) for fs in chunk]
+
+                for name in names:
+                    LOGGER.info('Creating snapshot %s (label: %s)', name, label)
+
+                args = [
+                    'snapshot',
+                ]
+
+                for key, value in properties.items():
+                    args.extend([
+                        '-o', '%s=%s' % (key, value),
+                    ])
+
+                if recursive:
+                    args.append('-r')
+
+                args.extend(names)
+                cmd = self.get_cmd('zfs', args)
+                subprocess.check_call(cmd, close_fds=False)
+
+                for name in names:
+                    snapshot = Snapshot(self, name, properties=dict(properties))
+                    self.cache_add_snapshot(snapshot)
+                    snapshots.append(snapshot)
+
+        return snapshots
 
 
 class ZFSSnap(object):
@@ -866,37 +1500,64 @@ class ZFSSnap(object):
             lockfile = self.lockfile
 
         self._lock = open(lockfile, 'w')
-        wait = 3
         timeout = 60
 
-        while timeout > 0:
-            try:
-                fcntl.lockf(self._lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
-                LOGGER.debug('Lock aquired')
-                return
-            except OSError:
-                LOGGER.info('zfssnap is already running. Waiting for '
-                            'lock release... (timeout: %ss)', timeout)
-                timeout = timeout - wait
-                time.sleep(wait)
+        try:
+            fcntl.lockf(self._lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            LOGGER.debug('Lock aquired')
+            return
+        except OSError:
+            LOGGER.info('zfssnap is already running. Waiting for '
+                        'lock release... (timeout: %ss)', timeout)
+
+        # Block on the lock instead of polling so that it is aquired as soon
+        # as it is released. The alarm interrupts the wait at the timeout.
+        def timeout_handler(signum, frame):
+            raise ZFSSnapException('Timeout reached. Could not aquire lock.')
+
+        previous_handler = signal.signal(signal.SIGALRM, timeout_handler)
+        signal.setitimer(signal.ITIMER_REAL, timeout)
+
+        try:
+            fcntl.lockf(self._lock, fcntl.LOCK_EX)
+        finally:
+            signal.setitimer(signal.ITIMER_REAL, 0)
+            signal.signal(signal.SIGALRM, previous_handler)
 
-        raise ZFSSnapException('Timeout reached. Could not aquire lock.')
+        LOGGER.debug('Lock aquired')
+
+    @staticmethod
+    def _wait_for_next_second():
+        # Snapshot names have second resolution. Any snapshot from a previous
+        # run was created before the lock was aquired, so waiting for the
+        # next whole second is enough to avoid a name collision.
+        sleep = 1 - time.time() % 1
+        LOGGER.debug('Sleeping %.3fs to avoid potential snapshot name '
+                     'collisions due to matching timestamps', sleep)
+        time.sleep(sleep)
 
     def _release_lock(self):
-        fcntl.flock(self._lock, fcntl.LOCK_UN)
+        # The lock is taken with lockf, so it must be released with lockf.
+        # flock locks are independent of lockf locks on Linux.
+        fcntl.lockf(self._lock, fcntl.LOCK_UN)
+        self._lock.close()
         LOGGER.debug('Lock released')
 
     @staticmethod
-    def _get_metadata_files(src_dir, label, file_prefix=None):
+    def _get_metadata_files(src_dir, label, file_prefix=None, file_names=None):
         if file_prefix is None:
             file_prefix = 'zfssnap'
 
-        metadata_pattern = r'^%s_[0-9]{8}T[0-9]{6}Z.json$' % file_prefix
+        if file_names is None:
+            file_names = [f.name for f in scandir(src_dir)]
+
+        metadata_pattern = r'^%s_[0-9]{8}T[0-9]{6}Z\.json$' % re.escape(file_prefix)
         metadata_re = re.compile(metadata_pattern)
+        current_version = parse_version(VERSION)
 
-        for f in scandir(src_dir):
-            if re.match(metadata_re, f.name):
-                metadata = MetadataFile(f.path)
+        for name in file_names:
+            if metadata_re.match(name):
+                metadata = MetadataFile(os.path.join(src_dir, name))
                 metadata.read()
 
                 if metadata.label != label:
@@ -906,7 +1567,7 @@ class ZFSSnap(object):
                         metadata.label, src_dir, file_prefix)
                     continue
 
-                if StrictVersion(metadata.version) > StrictVersion(VERSION):
+                if parse_version(metadata.version) > current_version:
                     raise ReplicationException(
                         'The incoming snapshot was generated using zfssnap '
                         'v%s, while this receiver is using the older zfssnap v%s. '
@@ -916,26 +1577,69 @@ class ZFSSnap(object):
                 yield metadata
 
     @staticmethod
-    def _run_replication_cmd(in_cmd, out_cmd, pv=True):
-        in_p = subprocess.Popen(in_cmd, stdout=subprocess.PIPE)
-        send = in_p
-
-        if pv:
-            pv_cmd = ['pv', '-rtb']
-            LOGGER.debug('Replication command: \'%s | %s | %s\'', ' '.join(in_cmd),
-                         ' '.join(pv_cmd), ' '.join(out_cmd))
-            pv_p = subprocess.Popen(pv_cmd, stdin=in_p.stdout,
-                                    stdout=subprocess.PIPE)
-            send = pv_p
-        else:
-            LOGGER.debug('Replication command: \'%s | %s\'', ' '.join(in_cmd),
-                         ' '.join(out_cmd))
-
-        out_p = subprocess.Popen(out_cmd, stdin=send.stdout,
-                                 stdout=subprocess.PIPE)
-        in_p.stdout.close()
-        if pv:
-            pv_p.stdout.close()
+    def _run_replication_cmd(in_cmd, out_cmd, pv_cmd=None, buffer_cmd=None,
+                             pipe_size=None, in_files=None, out_func=None):
+        cmds = [in_cmd] if in_cmd else []
+
+        if pv_cmd:
+            cmds.append(pv_cmd)
+
+        if buffer_cmd:
+            cmds.append(buffer_cmd)
+
+        if out_cmd:
+            cmds.append(out_cmd)
+
+        if LOGGER.isEnabledFor(logging.DEBUG):
+            LOGGER.debug('Replication command: \'%s\'',
+                         ' | '.join(' '.join(cmd) for cmd in cmds))
+
+        stdin = None
+        feeder = None
+        feeder_errors = []
+
+        if in_files is not None:
+            # Write the files to the first command from a thread instead of
+            # through cat, which saves a process and a copy of the stream
+            read_fd, write_fd = os.pipe()
+
+            if pipe_size:
+                set_pipe_size(write_fd, pipe_size)
+
+            def feed():
+                try:
+                    copy_files_to_fd(in_files, write_fd)
+                except OSError as e:
+                    feeder_errors.append(e)
+                finally:
+                    os.close(write_fd)
+
+            stdin = os.fdopen(read_fd, 'rb')
+            feeder = threading.Thread(target=feed)
+
+        for i, cmd in enumerate(cmds):
+            out_p = subprocess.Popen(cmd, stdin=stdin, stdout=subprocess.PIPE,
+                                     close_fds=False)
+
+            # A larger pipe between the stages absorbs short stalls on the
+            # receiving side without blocking the sending side. The last
+            # pipe only carries the receiving side output, unless the
+            # stream itself is handled by out_func.
+            if pipe_size and (i < len(cmds) - 1 or out_func):
+                actual_size = set_pipe_size(out_p.stdout.fileno(), pipe_size)
+
+                if LOGGER.isEnabledFor(logging.DEBUG):
+                    LOGGER.debug('Pipe size after \'%s\': %s bytes',
+                                 ' '.join(cmd), actual_size)
+
+            # Close the parent's copy of the previous pipe so that the
+            # upstream process receives SIGPIPE if a later stage exits
+            if stdin is not None:
+                stdin.close()
+            stdin = out_p.stdout
+
+        if feeder:
+            feeder.start()
 
         # Do not capture stderr_data as I have found no way to capture stderr
         # from the send process properly when using pipes without it beeing
@@ -944,18 +1648,30 @@ class ZFSSnap(object):
         # suggested. Instead of having the send stderr go directly to output
         # and receive printed using logging I just leave both untouched for
         # now.
-        lines = []
+        if out_func:
+            # Closing the pipe on errors makes the upstream process exit
+            with out_p.stdout:
+                output = out_func(out_p.stdout.fileno())
+            out_p.wait()
+        else:
+            output = []
+
+            while out_p.poll() is None:
+                for line in iter(out_p.stdout.readline, b''):
+                    line = line.strip().decode('utf8')
+                    LOGGER.info(line)
+                    output.append(line)
 
-        while out_p.poll() is None:
-            for line in iter(out_p.stdout.readline, b''):
-                line = line.strip().decode('utf8')
-                LOGGER.info(line)
-                lines.append(line)
+        if feeder:
+            feeder.join()
 
         if out_p.returncode != 0:
             raise ReplicationException('Replication failed')
 
-        return lines
+        if feeder_errors:
+            raise ReplicationException('Replication failed: %s' % feeder_errors[0])
+
+        return output
 
     @staticmethod
     def _enforce_read_only(fs, read_only):
@@ -968,13 +1684,33 @@ class ZFSSnap(object):
             LOGGER.info('Setting %s to read only', fs.name)
             fs.read_only = 'on'
 
-    def replicate(self, src_dataset, dst_dataset, label, base_snapshot, read_only=False):
+    def replicate(self, src_dataset, dst_dataset, label, base_snapshot, read_only=False,
+                  buffer_size='128k', buffer_mem='1G', send_flags=None,
+                  pipe_size=None):
+        # Parse the pipe size before the snapshot is created so that an
+        # invalid size doesn't leave an orphan snapshot behind
+        if pipe_size:
+            pipe_size = parse_size(pipe_size)
+
         _base_snapshot = src_dataset.get_base_snapshot(label, base_snapshot)
         snapshot = src_dataset.snapshot(label, recursive=True)
         LOGGER.info('Replicating %s to %s', src_dataset.name, dst_dataset.name)
-        send_cmd = src_dataset.get_send_cmd(snapshot, _base_snapshot)
+        send_cmd = src_dataset.get_send_cmd(snapshot, _base_snapshot, send_flags)
         receive_cmd = dst_dataset.get_receive_cmd()
-        self._run_replication_cmd(send_cmd, receive_cmd)
+        buffer_cmd = None
+
+        # Buffer the stream in front of zfs receive if mbuffer is available
+        # so that receive stalls does not throttle the sending side
+        if dst_dataset.host.cmds.get('mbuffer', None):
+            buffer_args = ['-q', '-s', buffer_size, '-m', buffer_mem]
+
+            if dst_dataset.host.is_remote:
+                receive_cmd = dst_dataset.get_buffered_receive_cmd(buffer_args)
+            else:
+                buffer_cmd = dst_dataset.get_buffer_cmd(buffer_args)
+
+        self._run_replication_cmd(send_cmd, receive_cmd, src_dataset.get_pv_cmd(),
+                                  buffer_cmd, pipe_size)
 
         # CAUTION!
         # There is potential for a race condition here. To ensure only
@@ -991,9 +1727,9 @@ class ZFSSnap(object):
         snapshot.repl_status = 'success'
 
         # For completeness also set repl_status to success on destination.
-        # The snapshot list must be refreshed as the dst_dataset snapshot cache
+        # The new snapshot must be loaded as the dst_dataset snapshot cache
         # does not know that a new snapshot has arrived
-        dst_snapshot = dst_dataset.get_snapshot(snapshot.snapshot_name, refresh=True)
+        dst_snapshot = dst_dataset.load_snapshot(snapshot.snapshot_name)
         dst_snapshot.repl_status = snapshot.repl_status
         self._enforce_read_only(dst_dataset, read_only)
 
@@ -1007,17 +1743,15 @@ class ZFSSnap(object):
             os.remove(os.path.join(src_dir, metadata.path))
 
     @staticmethod
-    def _get_segment_name(line, segments_log_re):
-        match = re.match(segments_log_re, line)
-        if match:
-            segment = match.group(1)
-            return os.path.basename(segment)
+    def _get_segments(src_dir, metadata_segments, src_file_names=None):
+        if src_file_names is None:
+            src_file_names = set()
 
-    @staticmethod
-    def _get_segments(src_dir, metadata_segments):
-        # Refresh file list for each run as each sync can potentially take
-        # a long time
-        src_file_names = {f.name for f in scandir(src_dir)}
+        # Only rescan the directory if segments are missing, as they may
+        # have arrived since the last scan. Each sync can potentially take
+        # a long time.
+        if not src_file_names.issuperset(metadata_segments):
+            src_file_names.update(f.name for f in scandir(src_dir))
 
         for segment in sorted(metadata_segments):
             if segment not in src_file_names:
@@ -1039,12 +1773,13 @@ class ZFSSnap(object):
 
         metadata.write()
 
-    def receive_from_file(self, dst_dataset, label, src_dir, metadata, read_only=False):
+    def receive_from_file(self, dst_dataset, label, src_dir, metadata, read_only=False,
+                          src_file_names=None):
         LOGGER.info('Selecting %s', metadata.path)
 
-        # Make sure the cache is refreshed as the snapshot count might have
-        # changed if multiple metadata files are processed in one run
-        previous_snapshot = dst_dataset.get_latest_repl_snapshot(label, refresh=True)
+        # Received snapshots are added to the cache below, so the cache is
+        # up to date even if multiple metadata files are processed in one run
+        previous_snapshot = dst_dataset.get_latest_repl_snapshot(label)
 
         if previous_snapshot and previous_snapshot.datetime >= metadata.datetime:
             LOGGER.warning('Ignoring %s as it is already applied or '
@@ -1057,44 +1792,45 @@ class ZFSSnap(object):
                 'The dependant snapshot %s does not exist on destination dataset %s' %
                 (metadata.depends_on, dst_dataset.name))
 
-        segments = self._get_segments(src_dir, metadata.segments)
-        cat_cmd = dst_dataset.get_cat_cmd(segments)
+        # Check that all segments exist before starting to receive
+        segments = list(self._get_segments(src_dir, metadata.segments, src_file_names))
         receive_cmd = dst_dataset.get_receive_cmd()
-        self._run_replication_cmd(cat_cmd, receive_cmd)
+        self._run_replication_cmd(None, receive_cmd, dst_dataset.get_pv_cmd(),
+                                  in_files=segments)
 
         # See comment in replicate()
         # Workaround for ZoL bug in initial replication fixed in 0.7.0?
         dst_snapshot = Snapshot(dst_dataset.host, '%s@%s' % (dst_dataset.name, metadata.snapshot))
-        dst_snapshot.label = metadata.label
-        dst_snapshot.version = metadata.version
-
-        #dst_snapshot = self.get_snapshot(metadata.snapshot)
-        dst_snapshot.repl_status = 'success'
+        dst_snapshot.set_properties({
+            ZFSSNAP_LABEL: metadata.label,
+            ZFSSNAP_VERSION: metadata.version,
+            ZFSSNAP_REPL_STATUS: 'success'
+        })
+        dst_dataset.host.cache_add_snapshot(dst_snapshot)
         self._enforce_read_only(dst_dataset, read_only)
 
         # Cleanup files after marking the sync as success as we don't
         # really care if this goes well for the sake of sync integrity
         self._cleanup_sync_files(metadata, src_dir)
 
-    def send_to_file(self, src_dataset, label, dst_dir, file_prefix='zfssnap', suffix_length=None,
-                     split_size=None, base_snapshot=None):
+    def send_to_file(self, src_dataset, label, dst_dir, file_prefix='zfssnap', suffix_length=4,
+                     split_size='1G', base_snapshot=None):
+        segment_size = parse_size(split_size)
         _base_snapshot = src_dataset.get_base_snapshot(label, base_snapshot)
         snapshot = src_dataset.snapshot(label, recursive=True)
         prefix = os.path.join(dst_dir, '%s_%s-' % (file_prefix, snapshot.timestamp))
 
-        segments_log_pattern = r'^creating\sfile\s.*(%s[a-z]{%s}).*$' % (prefix, suffix_length)
-        segments_log_re = re.compile(segments_log_pattern)
+        # Split the stream into segments directly instead of through split,
+        # which saves a process and a copy of the stream, and gives the
+        # segment names without parsing the split output
+        def write_stream(fd):
+            return write_segments(fd, prefix, segment_size, suffix_length)
 
+        LOGGER.info('Splitting at segment size %s', split_size)
         send_cmd = src_dataset.get_send_cmd(snapshot, _base_snapshot)
-        split_cmd = src_dataset.get_split_cmd(prefix, split_size, suffix_length)
-        output = self._run_replication_cmd(send_cmd, split_cmd)
-        segments = []
-
-        for line in output:
-            segment = self._get_segment_name(line, segments_log_re)
-
-            if segment:
-                segments.append(segment)
+        segment_paths = self._run_replication_cmd(send_cmd, None, src_dataset.get_pv_cmd(),
+                                                  out_func=write_stream)
+        segments = [os.path.basename(path) for path in segment_paths]
 
         LOGGER.info('Total segment count: %s', len(segments))
 
@@ -1110,56 +1846,87 @@ class ZFSSnap(object):
         snapshot.repl_status = 'success'
 
     def _run_snapshot_policy(self, policy, reset=False):
-        if not reset:
-            sleep = 1
-            LOGGER.debug('Sleeping %ss to avoid potential snapshot name '
-                         'collisions due to matching timestamps', sleep)
-            time.sleep(sleep)
-
         policy_config = self.config.get_policy(policy)
         label = policy_config['label']
         host = Host(cmds=policy_config['cmds'])
         recursive = policy_config['recursive']
-        datasets = host.get_fsvols(
-            policy_config.get('include', None),
-            policy_config.get('exclude', None),
-            recursive)
         keep = policy_config['keep']
+
+        # A new snapshot would be destroyed right away by the retention if
+        # nothing is to be kept
+        create_snapshots = not reset and any(keep.values())
+
         self._aquire_lock()
 
+        if create_snapshots:
+            self._wait_for_next_second()
+
+        # Populate the host cache before processing the datasets in parallel
+        datasets = list(host.get_fsvols(
+            policy_config.get('include', None),
+            policy_config.get('exclude', None),
+            recursive))
+
         if reset:
             LOGGER.warning('Reset is enabled. Removing all snapshots for this policy')
+        elif not create_snapshots:
+            LOGGER.warning('All keep values are 0. Not creating any snapshots.')
+        elif datasets:
+            # Snapshot all datasets at once instead of one zfs call each
+            host.snapshot_fsvols(datasets, label, recursive)
 
-        for dataset in datasets:
-            if not reset:
-                dataset.snapshot(label, recursive)
-
+        def enforce_retention(dataset):
             dataset.enforce_retention(keep, label, recursive, reset)
 
+        # The datasets are independent of each other and the work is mostly
+        # waiting on zfs, so process them concurrently
+        with ThreadPoolExecutor(max_workers=policy_config['parallel']) as executor:
+            futures = [executor.submit(enforce_retention, d) for d in datasets]
+
+        # Re-raise the first exception, if any
+        for future in futures:
+            future.result()
+
         self._release_lock()
 
-    def _run_replicate_policy(self, policy, reset=False, base_snapshot=None):
-        if not reset:
-            sleep = 1
-            LOGGER.debug('Sleeping %ss to avoid potential snapshot name '
-                         'collisions due to matching timestamps', sleep)
-            time.sleep(sleep)
+    @staticmethod
+    def _get_replication_fsvols(policy_config, src_host, dst_host, load_caches=False):
+        def get_fsvol(host, name):
+            if load_caches:
+                host.get_properties_cached()
+            return host.get_fsvol(name)
+
+        # The lookups are independent and the destination is usually a
+        # remote host, so overlap the round trips
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            src_future = executor.submit(
+                get_fsvol, src_host, policy_config['source']['dataset'])
+            dst_future = executor.submit(
+                get_fsvol, dst_host, policy_config['destination']['dataset'])
+
+        return src_future.result(), dst_future.result()
 
+    def _run_replicate_policy(self, policy, reset=False, base_snapshot=None):
         policy_config = self.config.get_policy(policy)
         src_host = Host(policy_config['source']['cmds'])
-        src_dataset = src_host.get_fsvol(policy_config['source']['dataset'])
 
         ssh_params = dict()
         ssh_params['ssh'] = policy_config['source']['cmds']['ssh']
         ssh_params['user'] = policy_config['destination']['ssh_user']
         ssh_params['host'] = policy_config['destination']['host']
+        ssh_params['control_master'] = policy_config['destination']['ssh_control_master']
+        ssh_params['cipher'] = policy_config['destination']['ssh_cipher']
 
         dst_host = Host(policy_config['destination']['cmds'], ssh_params)
-        dst_dataset = dst_host.get_fsvol(policy_config['destination']['dataset'])
+        src_dataset, dst_dataset = self._get_replication_fsvols(
+            policy_config, src_host, dst_host)
 
         label = policy_config['label']
         self._aquire_lock()
 
+        if not reset:
+            self._wait_for_next_second()
+
         if reset:
             LOGGER.warning('Reset is enabled. Reinitializing replication.')
             if dst_dataset:
@@ -1171,7 +1938,9 @@ class ZFSSnap(object):
                 dst_dataset = FsVol(dst_host, policy_config['destination']['dataset'])
 
             read_only = policy_config['destination']['read_only']
-            self.replicate(src_dataset, dst_dataset, label, base_snapshot, read_only)
+            self.replicate(src_dataset, dst_dataset, label, base_snapshot, read_only,
+                           policy_config['buffer_size'], policy_config['buffer_mem'],
+                           policy_config['send_flags'], policy_config['pipe_size'])
 
         keep = policy_config['keep']
         src_dataset.enforce_retention(keep, label, recursive=True, reset=reset,
@@ -1185,8 +1954,12 @@ class ZFSSnap(object):
             src_dir = policy_config['source']['dir']
             label = policy_config['label']
             file_prefix = policy_config.get('file_prefix', None)
-            metadata_files = [
-                f for f in self._get_metadata_files(src_dir, label, file_prefix)]
+
+            # Scan the directory once for both the metadata files and the
+            # segments
+            src_file_names = {f.name for f in scandir(src_dir)}
+            metadata_files = list(self._get_metadata_files(
+                src_dir, label, file_prefix, src_file_names))
 
             # Return early if no metadata files are found to avoid triggering
             # unnecessary cache refreshes against the host
@@ -1212,20 +1985,16 @@ class ZFSSnap(object):
             read_only = policy_config['destination']['read_only']
 
             try:
-                for metadata in sorted(metadata_files, key=attrgetter('datetime')):
-                    self.receive_from_file(dst_dataset, label, src_dir, metadata, read_only)
+                # The fixed width timestamps sort in chronological order
+                for metadata in sorted(metadata_files, key=attrgetter('timestamp')):
+                    self.receive_from_file(dst_dataset, label, src_dir, metadata, read_only,
+                                           src_file_names)
             except SegmentMissingException as e:
                 LOGGER.error(e)
 
         self._release_lock()
 
     def _run_send_to_file_policy(self, policy, reset=False, base_snapshot=None):
-        if not reset:
-            sleep = 1
-            LOGGER.debug('Sleeping %ss to avoid potential snapshot name '
-                         'collisions due to matching timestamps', sleep)
-            time.sleep(sleep)
-
         policy_config = self.config.get_policy(policy)
         label = policy_config['label']
         src_host = Host(policy_config['cmds'])
@@ -1238,6 +2007,9 @@ class ZFSSnap(object):
 
         self._aquire_lock()
 
+        if not reset:
+            self._wait_for_next_second()
+
         if reset:
             LOGGER.warning('Reset is enabled. Reinitializing replication.')
             LOGGER.warning('Cleaning up source replication snapshots')
@@ -1271,7 +2043,7 @@ class ZFSSnap(object):
 
     def _print_config(self, config):
         self._print_header('POLICY CONFIG')
-        print(yaml.dump(config, default_flow_style=False))
+        print(yaml.dump(config, Dumper=YAMLSafeDumper, default_flow_style=False))
 
     def _list_snapshot_policy(self, policy, list_mode):
         policy_config = self.config.get_policy(policy)
@@ -1328,15 +2100,18 @@ class ZFSSnap(object):
         policy_config = self.config.get_policy(policy)
         label = policy_config['label']
         src_host = Host(policy_config['source']['cmds'])
-        src_dataset = src_host.get_fsvol(policy_config['source']['dataset'])
 
         ssh_params = dict()
         ssh_params['ssh'] = policy_config['source']['cmds']['ssh']
         ssh_params['user'] = policy_config['destination']['ssh_user']
         ssh_params['host'] = policy_config['destination']['host']
+        ssh_params['control_master'] = policy_config['destination']['ssh_control_master']
+        ssh_params['cipher'] = policy_config['destination']['ssh_cipher']
 
         dst_host = Host(policy_config['destination']['cmds'], ssh_params)
-        dst_dataset = dst_host.get_fsvol(policy_config['destination']['dataset'])
+        src_dataset, dst_dataset = self._get_replication_fsvols(
+            policy_config, src_host, dst_host,
+            load_caches=list_mode == 'snapshots')
 
         if dst_dataset:
             dst_datasets = [dst_dataset]
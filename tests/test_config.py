@@ -0,0 +1,142 @@
+import pytest
+import os
+
+from zfssnap import Config, ConfigException
+
+CONFIG = """
+policies:
+  test:
+    type: snapshot
+    keep:
+      hourly: 24
+  other:
+    type: snapshot
+    keep:
+      daily: 7
+  numeric:
+    type: snapshot
+    label: 123
+  tofile:
+    type: send_to_file
+    split_size: 1T
+  repl:
+    type: replicate
+    source:
+      dataset: tank/src
+    destination:
+      dataset: backup/dst
+"""
+
+class TestConfig(object):
+    @pytest.fixture
+    def config_file(self, tmpdir):
+        path = tmpdir.join('zfssnap.yml')
+        path.write(CONFIG)
+        return str(path)
+
+    @pytest.fixture
+    def cache_file(self, tmpdir):
+        return str(tmpdir.join('cache', 'config.json'))
+
+    def test_get_policy(self, config_file, cache_file):
+        config = Config(config_file, cache_file)
+        policy = config.get_policy('test')
+        assert policy['keep']['hourly'] == 24
+        assert policy['label'] == 'test'
+
+    def test_numeric_label(self, config_file, cache_file):
+        config = Config(config_file, cache_file)
+        assert config.get_policy('numeric')['label'] == '123'
+
+    def test_undefined_policy(self, config_file, cache_file):
+        config = Config(config_file, cache_file)
+        with pytest.raises(ConfigException):
+            config.get_policy('undefined')
+
+    def test_cache_is_written(self, config_file, cache_file):
+        Config(config_file, cache_file)
+        assert os.path.isfile(cache_file)
+
+    def test_cache_is_used(self, monkeypatch, config_file, cache_file):
+        Config(config_file, cache_file)
+
+        def mock_load(f, Loader=None):
+            raise AssertionError('config was parsed')
+
+        monkeypatch.setattr('yaml.load', mock_load)
+        monkeypatch.setattr(Config, '_parsed', {})
+        config = Config(config_file, cache_file)
+        assert config.get_policy('test')['keep']['hourly'] == 24
+
+    def test_cache_invalidated_on_change(self, config_file, cache_file):
+        Config(config_file, cache_file)
+
+        with open(config_file, 'w') as f:
+            f.write(CONFIG.replace('24', '6'))
+
+        config = Config(config_file, cache_file)
+        assert config.get_policy('test')['keep']['hourly'] == 6
+
+    def test_non_string_keys_are_not_cached(self, monkeypatch, config_file, cache_file):
+        with open(config_file, 'a') as f:
+            f.write('    cmds:\n      1: /sbin/zfs\n')
+
+        cold = Config(config_file, cache_file).get_policy('repl')
+        monkeypatch.setattr(Config, '_parsed', {})
+        warm = Config(config_file, cache_file).get_policy('repl')
+
+        assert not os.path.isfile(cache_file)
+        assert warm == cold
+        assert 1 in warm['cmds']
+
+    def test_unwritable_cache(self, config_file):
+        config = Config(config_file, '/proc/zfssnap/config.json')
+        assert config.get_policy('test')['keep']['hourly'] == 24
+
+    def test_parsed_config_is_reused(self, monkeypatch, config_file):
+        config_1 = Config(config_file, '/proc/zfssnap/config.json')
+
+        def mock_load(f, Loader=None):
+            raise AssertionError('config was parsed')
+
+        monkeypatch.setattr('yaml.load', mock_load)
+        config_2 = Config(config_file, '/proc/zfssnap/config.json')
+        config_1.config['policies']['test']['keep']['hourly'] = 1
+        assert config_2.get_policy('test')['keep']['hourly'] == 24
+
+    def test_policy_is_reused(self, config_file, cache_file):
+        config = Config(config_file, cache_file)
+        assert config.get_policy('test') is config.get_policy('test')
+
+    def test_policies_do_not_share_keep(self, config_file, cache_file):
+        config = Config(config_file, cache_file)
+        assert config.get_policy('test')['keep']['daily'] == 0
+        assert config.get_policy('other')['keep']['hourly'] == 0
+        assert config.global_defaults['keep']['hourly'] == 0
+
+    def test_ssh_control_master_is_opt_in(self, config_file, cache_file):
+        config = Config(config_file, cache_file)
+        assert not config.get_policy('repl')['destination']['ssh_control_master']
+
+    def test_invalid_pipe_size(self, config_file, cache_file):
+        with open(config_file, 'a') as f:
+            f.write('    pipe_size: 1.5M\n')
+
+        config = Config(config_file, cache_file)
+        with pytest.raises(ConfigException):
+            config.get_policy('repl')
+
+    def test_split_size_suffix(self, config_file, cache_file):
+        config = Config(config_file, cache_file)
+        assert config.get_policy('tofile')['split_size'] == '1T'
+
+    def test_invalid_split_size(self, config_file, cache_file):
+        with open(config_file) as f:
+            content = f.read()
+
+        with open(config_file, 'w') as f:
+            f.write(content.replace('split_size: 1T', 'split_size: 1.5G'))
+
+        config = Config(config_file, cache_file)
+        with pytest.raises(ConfigException):
+            config.get_policy('tofile')
@@ -0,0 +1,120 @@
+import pytest
+import subprocess
+
+from zfssnap import Host, Snapshot
+
+SNAPSHOT = 'dev-1/test-1@zfssnap_20170119T094102Z'
+
+class TestHost(object):
+    @pytest.fixture
+    def create_host(self, monkeypatch):
+        """Returns a function creating a host where zfs list outputs the
+        given lines. A dict maps the listed dataset to its output, with the
+        output of a full listing under None. An exception as output is
+        raised. The args of every zfs list are recorded in host.calls."""
+        def create_host(output):
+            host = Host({'zfs': 'zfs'})
+            host.calls = []
+
+            def run_stream(cmd, args, stderr=None):
+                host.calls.append(args)
+                lines = output
+
+                if isinstance(output, dict):
+                    lines = output.get(args[-1], output.get(None, []))
+                if isinstance(lines, Exception):
+                    raise lines
+
+                for line in lines:
+                    yield line
+
+            monkeypatch.setattr(host, '_run_stream', run_stream)
+            return host
+        return create_host
+
+    def test_unset_property_does_not_refresh_cache(self, create_host):
+        host = create_host(['%s\tsnapshot\t-\tlabel\t-\t3.8.0' % SNAPSHOT])
+        snapshot = Snapshot(host, SNAPSHOT)
+        host.get_properties_cached()
+
+        assert snapshot.repl_status is None
+        assert snapshot.repl_status is None
+        assert len(host.calls) == 1
+
+    def test_load_snapshot_only_fetches_snapshot(self, create_host):
+        host = create_host({
+            None: ['dev-1/test-1\tfilesystem\toff\t-\t-\t-'],
+            SNAPSHOT: ['%s\tsnapshot\t-\tlabel\tsuccess\t3.8.0' % SNAPSHOT]
+        })
+        fs = list(host.get_fsvols())[0]
+        snapshot = fs.load_snapshot('zfssnap_20170119T094102Z')
+
+        assert snapshot.name == SNAPSHOT
+        assert snapshot.repl_status == 'success'
+        assert fs.get_snapshot('zfssnap_20170119T094102Z') is snapshot
+        assert len(host.calls) == 2
+
+    def test_get_fsvol_without_loaded_cache(self, create_host):
+        host = create_host({
+            'dev-1/test-1': ['dev-1/test-1\tfilesystem\ton\t-\t-\t-'],
+            'dev-1/missing': subprocess.CalledProcessError(
+                1, 'zfs', b"cannot open 'dev-1/missing': dataset does not exist\n")
+        })
+
+        assert host.get_fsvol('dev-1/test-1').read_only == 'on'
+        assert host.get_fsvol('dev-1/missing') is None
+        assert [args[-1] for args in host.calls] == ['dev-1/test-1', 'dev-1/missing']
+
+    def test_get_fsvol_raises_other_errors(self, create_host):
+        host = create_host(subprocess.CalledProcessError(255, 'ssh', b'Permission denied\n'))
+
+        with pytest.raises(subprocess.CalledProcessError):
+            host.get_fsvol('dev-1/test-1')
+
+    def test_get_fsvols_does_not_extend_exclude(self, create_host):
+        host = create_host([
+            'dev-1\tfilesystem\toff\t-\t-\t-',
+            'dev-1/test-1\tfilesystem\toff\t-\t-\t-'
+        ])
+        include = ['dev-1']
+        exclude = []
+
+        for _ in range(2):
+            fsvols = list(host.get_fsvols(include, exclude, recursive=True))
+            assert [fs.name for fs in fsvols] == ['dev-1']
+        assert exclude == []
+
+    def test_get_snapshot_by_name(self, create_host):
+        host = create_host([
+            'dev-1/test-1\tfilesystem\toff\t-\t-\t-',
+            'dev-1/test-2\tfilesystem\toff\t-\t-\t-',
+            'dev-1/test-2@zfssnap_20170119T094102Z\tsnapshot\t-\tlabel\t-\t3.8.0'
+        ])
+        fs_1 = host.get_fsvol('dev-1/test-1')
+        fs_2 = host.get_fsvol('dev-1/test-2')
+
+        assert fs_1.get_snapshot('zfssnap_20170119T094102Z') is None
+        snapshot = fs_2.get_snapshot('zfssnap_20170119T094102Z')
+        assert snapshot.name == 'dev-1/test-2@zfssnap_20170119T094102Z'
+
+        host.cache_remove_snapshot(snapshot)
+        assert fs_2.get_snapshot('zfssnap_20170119T094102Z') is None
+
+    def test_get_fsvol_uses_loaded_properties(self, create_host):
+        host = create_host(['dev-1/test-1\tfilesystem\toff\t-\t-\t-'])
+        host.get_properties_cached()
+
+        assert host.get_fsvol('dev-1/test-1').name == 'dev-1/test-1'
+        assert host.get_fsvol('dev-1/missing') is None
+        assert len(host.calls) == 1
+
+    def test_only_zfssnap_snapshots_are_cached(self, create_host):
+        host = create_host([
+            'dev-1/test-1\tfilesystem\toff\t-\t-\t-',
+            'dev-1/test-1@manual\tsnapshot\t-\t-\t-\t-',
+            'dev-1/test-1@zfssnap_2017\tsnapshot\t-\t-\t-\t-',
+            'dev-1/test-1@zfssnap_20170119T094102Z\tsnapshot\t-\t-\t-\t-'
+        ])
+        snapshots = list(host.cache_get_snapshots())
+
+        assert [s.name for s in snapshots] == [SNAPSHOT]
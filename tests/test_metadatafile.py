@@ -254,3 +254,9 @@ class TestMetadataFile(object):
         monkeypatch.setattr(metadata_attr_tests, '_label', None)
         with pytest.raises(MetadataFileException):
             metadata_attr_tests.write()
+
+    def test_datetime_follows_timestamp(self, metadata):
+        metadata.timestamp = '20170116T160746Z'
+        metadata.datetime
+        metadata.timestamp = '20180116T160746Z'
+        assert metadata.datetime.year == 2018
@@ -2,7 +2,7 @@ import pytest
 import datetime
 import subprocess
 
-from zfssnap import Host, Snapshot, ZFSSNAP_REPL_STATUS, ZFSSNAP_LABEL, ZFSSNAP_VERSION
+from zfssnap import Host, FsVol, Snapshot, ZFSSNAP_REPL_STATUS, ZFSSNAP_LABEL, ZFSSNAP_VERSION
 
 class TestSnapshot(object):
     @pytest.fixture
@@ -20,3 +20,48 @@ class TestSnapshot(object):
     def test_snapshot_datetime(self, snapshot):
         assert snapshot.datetime == datetime.datetime(
             2017, 1, 19, 9, 41, 2, tzinfo=datetime.timezone.utc)
+
+    def test_set_properties(self, monkeypatch, snapshot):
+        calls = []
+        monkeypatch.setattr('subprocess.check_call',
+                            lambda cmd, **kwargs: calls.append(cmd))
+        snapshot.set_properties({
+            ZFSSNAP_VERSION: '3.8.0',
+            ZFSSNAP_LABEL: 'test',
+            ZFSSNAP_REPL_STATUS: None
+        })
+
+        assert calls == [
+            ['zfs', 'inherit', ZFSSNAP_REPL_STATUS, snapshot.name],
+            ['zfs', 'set', '%s=test' % ZFSSNAP_LABEL,
+             '%s=3.8.0' % ZFSSNAP_VERSION, snapshot.name]
+        ]
+        assert snapshot.host._dataset_properties[snapshot.name] == {
+            'type': 'snapshot',
+            ZFSSNAP_LABEL: 'test',
+            ZFSSNAP_VERSION: '3.8.0'
+        }
+
+    def test_set_properties_one_by_one(self, monkeypatch, snapshot):
+        calls = []
+
+        def check_call(cmd, **kwargs):
+            calls.append(cmd)
+            if len(cmd) > 4:
+                raise subprocess.CalledProcessError(1, cmd)
+
+        monkeypatch.setattr('subprocess.check_call', check_call)
+        snapshot.set_properties({ZFSSNAP_LABEL: 'test', ZFSSNAP_VERSION: '3.8.0'})
+
+        assert calls[1:] == [
+            ['zfs', 'set', '%s=test' % ZFSSNAP_LABEL, snapshot.name],
+            ['zfs', 'set', '%s=3.8.0' % ZFSSNAP_VERSION, snapshot.name]
+        ]
+        assert snapshot.host._dataset_properties[snapshot.name][ZFSSNAP_LABEL] == 'test'
+
+    def test_pv_cmd(self):
+        fs = FsVol(Host({'zfs': 'zfs', 'pv': '/usr/bin/pv'}), 'dev-1/test-1')
+        assert fs.get_pv_cmd() == ['/usr/bin/pv', '-rtb']
+
+        fs = FsVol(Host({'zfs': 'zfs', 'pv': None}), 'dev-1/test-1')
+        assert fs.get_pv_cmd() is None
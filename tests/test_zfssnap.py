@@ -1,10 +1,110 @@
+import errno
+import os
+
 import pytest
 
-from zfssnap import autotype
+from zfssnap import (parse_size, parse_version, set_pipe_size,
+                     get_pipe_max_size, copy_files_to_fd, write_segments,
+                     ReplicationException, SegmentMissingException, ZFSSnap)
 
 class TestZFSSnap(object):
-    def test_autotype_to_int(self):
-        assert isinstance(autotype('123'), int)
+    def test_parse_version(self):
+        assert parse_version('3.8.0') == (3, 8, 0)
+        assert parse_version('3.8') == (3, 8, 0)
+        assert parse_version('3.10.0') > parse_version('3.9.1')
+
+    def test_parse_size(self):
+        assert parse_size('512') == 512
+        assert parse_size('128k') == 128 * 1024
+        assert parse_size('1M') == 1024 * 1024
+        assert parse_size('2g') == 2 * 1024 ** 3
+        assert parse_size('1T') == 1024 ** 4
+        assert parse_size('1MiB') == 1024 * 1024
+        assert parse_size('1MB') == 1000 * 1000
+        assert parse_size('2b') == 1024
+
+    def test_parse_invalid_size(self):
+        for value in ('', '1.5M', '1X', 'M', '-1M'):
+            with pytest.raises(ValueError):
+                parse_size(value)
+
+    def test_set_pipe_size(self):
+        r, w = os.pipe()
+        try:
+            assert set_pipe_size(w, 128 * 1024) == 128 * 1024
+        finally:
+            os.close(r)
+            os.close(w)
+
+    def test_set_pipe_size_above_max(self):
+        max_size = get_pipe_max_size()
+        r, w = os.pipe()
+        try:
+            assert set_pipe_size(w, max_size * 2) >= max_size
+        finally:
+            os.close(r)
+            os.close(w)
+
+    def _copy_files(self, tmpdir):
+        paths = []
+        for i, data in enumerate([b'abc', b'', b'def' * 1000]):
+            path = tmpdir.join('segment-%d' % i)
+            path.write_binary(data)
+            paths.append(str(path))
+
+        # The data fits in the pipe buffer, so it can be read afterwards
+        r, w = os.pipe()
+        copy_files_to_fd(paths, w, chunk_size=512)
+        os.close(w)
+
+        with open(r, 'rb') as f:
+            return f.read()
+
+    def test_copy_files_to_fd(self, tmpdir):
+        assert self._copy_files(tmpdir) == b'abc' + b'def' * 1000
+
+    def test_copy_files_to_fd_without_splice(self, monkeypatch, tmpdir):
+        def splice(*args):
+            raise OSError(errno.EINVAL, 'Invalid argument')
+
+        monkeypatch.setattr(os, 'splice', splice, raising=False)
+        assert self._copy_files(tmpdir) == b'abc' + b'def' * 1000
+
+    def _write_segments(self, tmpdir, data, segment_size, suffix_length=4):
+        r, w = os.pipe()
+        os.write(w, data)
+        os.close(w)
+
+        try:
+            prefix = str(tmpdir.join('zfssnap-'))
+            return write_segments(r, prefix, segment_size, suffix_length)
+        finally:
+            os.close(r)
+
+    def test_write_segments(self, tmpdir):
+        segments = self._write_segments(tmpdir, b'x' * 50, 20)
+        assert [os.path.basename(s) for s in segments] == [
+            'zfssnap-aaaa', 'zfssnap-aaab', 'zfssnap-aaac']
+        assert [os.path.getsize(s) for s in segments] == [20, 20, 10]
+
+    def test_write_segments_exact_size(self, tmpdir):
+        segments = self._write_segments(tmpdir, b'x' * 40, 20)
+        assert len(segments) == 2
+        assert sorted(os.listdir(str(tmpdir))) == ['zfssnap-aaaa', 'zfssnap-aaab']
+
+    def test_write_segments_suffixes_exhausted(self, tmpdir):
+        with pytest.raises(ReplicationException):
+            self._write_segments(tmpdir, b'x' * 27, 1, suffix_length=1)
+
+    def test_get_segments_rescans_on_miss(self, tmpdir):
+        tmpdir.join('segment-aa').write('')
+        src_file_names = {'segment-aa'}
+        tmpdir.join('segment-ab').write('')
+
+        segments = list(ZFSSnap._get_segments(
+            str(tmpdir), ['segment-ab', 'segment-aa'], src_file_names))
+        assert segments == [str(tmpdir.join('segment-aa')), str(tmpdir.join('segment-ab'))]
+        assert 'segment-ab' in src_file_names
 
-    def test_autotype_to_str(self):
-        assert isinstance(autotype('12f'), str)
\ No newline at end of file
+        with pytest.raises(SegmentMissingException):
+            list(ZFSSnap._get_segments(str(tmpdir), ['segment-ac'], src_file_names))